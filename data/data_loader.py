@@ -1,6 +1,7 @@
 ### Copyright (C) 2020 Roy Or-El. All rights reserved.
 ### Licensed under the CC BY-NC-SA 4.0 license (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode).
 import torch.utils.data
+import torch.utils.data.distributed
 from data.multiclass_unaligned_dataset import MulticlassUnalignedDataset
 from pdb import set_trace as st
 
@@ -11,29 +12,46 @@ class AgingDataLoader():
     def initialize(self, opt):
         self.opt = opt
         self.dataset = CreateDataset(opt)
+        if opt.isTrain and opt.distributed:
+            # training pairs are drawn at random, the sampler only splits the epoch length between the processes
+            self.sampler = torch.utils.data.distributed.DistributedSampler(
+                self.dataset,
+                num_replicas=opt.world_size,
+                rank=opt.rank,
+                shuffle=not opt.serial_batches,
+                drop_last=True)
+        else:
+            self.sampler = None
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=opt.batchSize,
-            shuffle=not opt.serial_batches,
+            shuffle=(not opt.serial_batches) and self.sampler is None,
+            sampler=self.sampler,
             drop_last=True,
-            num_workers=int(opt.nThreads))
+            num_workers=int(opt.nThreads),
+            pin_memory=len(opt.gpu_ids) > 0)
 
     def load_data(self):
         return self.dataloader
 
     def __len__(self):
+        # in distributed mode this is the number of samples each process iterates over per epoch
+        if self.sampler is not None:
+            return min(len(self.sampler), self.opt.max_dataset_size)
         return min(len(self.dataset), self.opt.max_dataset_size)
 
 
 def CreateDataset(opt):
     dataset = MulticlassUnalignedDataset()
-    print("dataset [%s] was created" % (dataset.name()))
+    if opt.rank == 0:
+        print("dataset [%s] was created" % (dataset.name()))
     dataset.initialize(opt)
     return dataset
 
 
 def CreateDataLoader(opt):
     data_loader = AgingDataLoader()
-    print(data_loader.name())
+    if opt.rank == 0:
+        print(data_loader.name())
     data_loader.initialize(opt)
     return data_loader
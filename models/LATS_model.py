@@ -3,13 +3,13 @@
 import numpy as np
 import torch
 import torch.nn as nn
-import re
-import functools
+import torch.distributed as dist
+import contextlib
+import inspect
 from collections import OrderedDict
 from .base_model import BaseModel
 import util.util as util
 from . import networks
-from pdb import set_trace as st
 
 class LATS(BaseModel): #Lifetime Age Transformation Synthesis
     def name(self):
@@ -18,6 +18,12 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
     def initialize(self, opt):
         BaseModel.initialize(self, opt)
 
+        # one process per GPU, the process group must exist before wrapping the networks
+        self.distributed = self.isTrain and opt.distributed
+        if self.distributed and not dist.is_initialized():
+            torch.cuda.set_device(opt.local_rank)
+            dist.init_process_group(backend='nccl')
+
         # if opt.resize_or_crop != 'none': # when training at full res this causes OOM
         torch.backends.cudnn.benchmark = True
 
@@ -45,6 +51,7 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
 
         self.numClasses = opt.numClasses
         self.use_moving_avg = not opt.no_moving_avg
+        self.use_amp = self.isTrain and opt.amp
 
         self.no_cond_noise = opt.no_cond_noise
         style_dim = opt.gen_dim_per_style * self.numClasses
@@ -52,6 +59,13 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
 
         self.cond_length = style_dim
 
+        # persistent generator for the condition noise, it lives on the same device as the inputs
+        self.cond_generator = torch.Generator(device='cuda' if len(self.gpu_ids) > 0 else 'cpu')
+        if not self.isTrain and opt.random_seed != -1:
+            self.cond_generator.manual_seed(opt.random_seed)
+        else:
+            self.cond_generator.seed()
+
         # self.active_classes_mapping = opt.active_classes_mapping
 
         if not self.isTrain:
@@ -60,29 +74,30 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
             self.debug_mode = False
 
         ##### define networks
-        # Generators
+        # Generators, G runs a single synchronized forward/backward per iteration so its DDP graph is static
         self.netG = self.parallelize(networks.define_G(opt.input_nc, opt.output_nc, opt.ngf, opt.n_downsample,
                                      id_enc_norm=opt.id_enc_norm, gpu_ids=self.gpu_ids, padding_type='reflect', style_dim=style_dim,
                                      init_type='kaiming', conv_weight_norm=opt.conv_weight_norm,
                                      decoder_norm=opt.decoder_norm, activation=opt.activation,
                                      adaptive_blocks=opt.n_adaptive_blocks, normalize_mlp=opt.normalize_mlp,
-                                     modulated_conv=opt.use_modulated_conv))
+                                     modulated_conv=opt.use_modulated_conv, verbose=opt.rank == 0), static_graph=True)
         if self.isTrain and self.use_moving_avg:
             self.g_running = networks.define_G(opt.input_nc, opt.output_nc, opt.ngf, opt.n_downsample,
                                                id_enc_norm=opt.id_enc_norm, gpu_ids=self.gpu_ids, padding_type='reflect', style_dim=style_dim,
                                                init_type='kaiming', conv_weight_norm=opt.conv_weight_norm,
                                                decoder_norm=opt.decoder_norm, activation=opt.activation,
                                                adaptive_blocks=opt.n_adaptive_blocks, normalize_mlp=opt.normalize_mlp,
-                                               modulated_conv=opt.use_modulated_conv)
+                                               modulated_conv=opt.use_modulated_conv, verbose=opt.rank == 0)
             self.g_running.train(False)
             self.requires_grad(self.g_running, flag=False)
-            self.accumulate(self.g_running, self.netG, decay=0)
+            self.ema_tensors, self.ema_source_tensors = self.paired_parameters(self.g_running, self.netG)
+            self.accumulate(decay=0)
 
         # Discriminator network
         if self.isTrain:
             self.netD = self.parallelize(networks.define_D(opt.output_nc, opt.ndf, n_layers=opt.n_layers_D,
                                          numClasses=self.numClasses, gpu_ids=self.gpu_ids,
-                                         init_type='kaiming'))
+                                         init_type='kaiming', verbose=opt.rank == 0))
 
         if self.opt.verbose:
                 print('---------- Networks initialized -------------')
@@ -100,22 +115,38 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
             else:
                 self.load_network(self.netG, 'G', opt.which_epoch, pretrained_path)
 
+        # NHWC activations are faster for the inference convolutions on tensor core GPUs
+        self.use_channels_last = (not self.isTrain) and len(self.gpu_ids) > 0 and hasattr(torch, 'channels_last')
+        if self.use_channels_last:
+            self.netG = self.netG.to(memory_format=torch.channels_last)
+
+        # CUDA graph of the class translation in test mode, captured on the first call to inference()
+        self.use_cuda_graph = (not self.isTrain) and len(self.gpu_ids) > 0 and hasattr(torch.cuda, 'graph') and \
+                              not (self.traverse or self.deploy or opt.no_cuda_graph)
+        self.infer_graph = None
+        self.infer_graph_shape = None
+        # inference output buffers for the non graph path, allocated on the first call to inference()
+        self.fake_B_buf = None
+        self.cyc_A_buf = None
+
 
         # set loss functions and optimizers
         if self.isTrain:
             # define loss functions
-            self.criterionGAN = self.parallelize(networks.SelectiveClassesNonSatGANLoss())
-            self.R1_reg = networks.R1_reg()
-            self.age_reconst_criterion = self.parallelize(networks.FeatureConsistency())
-            self.identity_reconst_criterion = self.parallelize(networks.FeatureConsistency())
-            self.criterionCycle = self.parallelize(networks.FeatureConsistency()) #torch.nn.L1Loss()
-            self.criterionRec = self.parallelize(networks.FeatureConsistency()) #torch.nn.L1Loss()
+            # the losses have no parameters, they run directly on the output device
+            self.criterionGAN = networks.SelectiveClassesNonSatGANLoss()
+            self.R1_reg = networks.R1_reg() # differentiates D w.r.t. its input, never wrap it in DataParallel
+            self.age_reconst_criterion = networks.FeatureConsistency()
+            self.identity_reconst_criterion = networks.FeatureConsistency()
+            self.criterionCycle = networks.FeatureConsistency() #torch.nn.L1Loss()
+            self.criterionRec = networks.FeatureConsistency() #torch.nn.L1Loss()
 
             # initialize optimizers
             self.old_lr = opt.lr
 
             # set optimizer G
-            paramsG = []
+            decayed_params = []
+            regular_params = []
             params_dict_G = dict(self.netG.named_parameters())
             # set the MLP learning rate to 0.01 or the global learning rate
             for key, value in params_dict_G.items():
@@ -123,46 +154,121 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
                 if opt.decay_adain_affine_layers:
                     decay_cond = decay_cond or ('class_std' in key) or ('class_mean' in key)
                 if decay_cond:
-                    paramsG += [{'params':[value],'lr':opt.lr * 0.01,'mult':0.01}]
+                    decayed_params += [value]
                 else:
-                    paramsG += [{'params':[value],'lr':opt.lr}]
+                    regular_params += [value]
 
-            self.optimizer_G = torch.optim.Adam(paramsG, lr=opt.lr, betas=(opt.beta1, opt.beta2))
+            # one group per learning rate lets the fused optimizer update each group in a single pass
+            paramsG = [{'params':decayed_params,'lr':opt.lr * 0.01,'mult':0.01},
+                       {'params':regular_params,'lr':opt.lr}]
+
+            self.optimizer_G = self.define_optimizer(paramsG)
 
             # set optimizer D
             paramsD = list(self.netD.parameters())
-            self.optimizer_D = torch.optim.Adam(paramsD, lr=opt.lr, betas=(opt.beta1, opt.beta2))
+            self.optimizer_D = self.define_optimizer(paramsD)
+
+            # mixed precision loss scalers, only created when amp is enabled
+            self.scaler_G = self.define_scaler()
+            self.scaler_D = self.define_scaler()
 
 
-    def parallelize(self, model):
+    def define_optimizer(self, params):
+        # the fused Adam implementation updates all parameters in a single CUDA kernel
+        # instead of launching one kernel per parameter tensor
+        use_fused = len(self.gpu_ids) > 0 and 'fused' in inspect.signature(torch.optim.Adam).parameters
+        if use_fused:
+            return torch.optim.Adam(params, lr=self.opt.lr, betas=(self.opt.beta1, self.opt.beta2), fused=True)
+        else:
+            return torch.optim.Adam(params, lr=self.opt.lr, betas=(self.opt.beta1, self.opt.beta2))
+
+
+    def define_scaler(self):
+        # torch.amp.GradScaler replaces the deprecated torch.cuda.amp.GradScaler in newer PyTorch versions
+        if not self.use_amp:
+            return None
+        elif hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler('cuda')
+        else:
+            return torch.cuda.amp.GradScaler()
+
+
+    def autocast(self):
+        # mixed precision context for the training forward passes
+        if not self.use_amp:
+            return contextlib.nullcontext()
+        elif hasattr(torch.amp, 'autocast'):
+            return torch.amp.autocast('cuda', dtype=torch.float16)
+        else:
+            return torch.cuda.amp.autocast()
+
+
+    def optimizer_step(self, loss, optimizer, scaler=None):
+        # backward pass and parameter update, through the loss scaler when amp is enabled
+        if scaler is None:
+            loss.backward()
+            optimizer.step()
+        else:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+
+    def parallelize(self, model, static_graph=False):
         # parallelize a network
         if self.isTrain and len(self.gpu_ids) > 0:
+            if self.distributed:
+                return networks._CustomDistributedDataParallel(model, self.opt.local_rank, static_graph=static_graph)
             return networks._CustomDataParallel(model)
         else:
             return model
 
 
+    def no_sync(self, model):
+        # disable DDP gradient synchronization for a forward pass whose gradients are discarded
+        if isinstance(model, nn.parallel.DistributedDataParallel):
+            return model.no_sync()
+        else:
+            return contextlib.nullcontext()
+
+
     def requires_grad(self, model, flag=True):
         # freeze network weights
         for p in model.parameters():
             p.requires_grad = flag
 
 
-    def accumulate(self, model1, model2, decay=0.999):
-        # implements exponential moving average
-        params1 = dict(model1.named_parameters())
+    def paired_parameters(self, model1, model2):
+        # match the parameters of model1 to model2 by name, accounting for parallel wrappers
+        model1_parallel = isinstance(model1, (nn.DataParallel, nn.parallel.DistributedDataParallel))
+        model2_parallel = isinstance(model2, (nn.DataParallel, nn.parallel.DistributedDataParallel))
         params2 = dict(model2.named_parameters())
-        model1_parallel = isinstance(model1, nn.DataParallel)
-        model2_parallel = isinstance(model2, nn.DataParallel)
 
-        for k in params1.keys():
+        tensors1 = []
+        tensors2 = []
+        for k, v in model1.named_parameters():
             if model2_parallel and not model1_parallel:
                 k2 = 'module.' + k
             elif model1_parallel and not model2_parallel:
-                k2 = re.sub('module.', '', k)
+                k2 = k.replace('module.', '', 1)
             else:
                 k2 = k
-            params1[k].data.mul_(decay).add_(1 - decay, params2[k2].data)
+            tensors1.append(v.data)
+            tensors2.append(params2[k2].data)
+
+        return tensors1, tensors2
+
+
+    def accumulate(self, decay=0.999):
+        # implements exponential moving average of netG into g_running.
+        # The parameter tensors are paired once in initialize() (loading weights copies into them in place),
+        # and all of them are updated with two multi-tensor kernels when PyTorch provides them
+        if hasattr(torch, '_foreach_mul_'):
+            torch._foreach_mul_(self.ema_tensors, decay)
+            torch._foreach_add_(self.ema_tensors, self.ema_source_tensors, alpha=1 - decay)
+        else:
+            for ema_tensor, source_tensor in zip(self.ema_tensors, self.ema_source_tensors):
+                ema_tensor.mul_(decay).add_(source_tensor, alpha=1 - decay)
 
 
     def set_inputs(self, data, mode='train'):
@@ -174,10 +280,18 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
             self.class_A = data['A_class']
             self.class_B = data['B_class']
 
+            # copy the pinned batches asynchronously before concatenating on the GPU,
+            # the classes are moved once here so building the conditions needs no host copies
+            if len(self.gpu_ids) > 0:
+                real_A = real_A.cuda(non_blocking=True)
+                real_B = real_B.cuda(non_blocking=True)
+                self.class_A = self.class_A.cuda(non_blocking=True)
+                self.class_B = self.class_B.cuda(non_blocking=True)
+
             self.reals = torch.cat((real_A, real_B), 0)
 
-            if len(self.gpu_ids) > 0:
-                self.reals = self.reals.cuda()
+            # draw the conditions once per batch, they are shared by the D and G steps
+            self.get_conditions()
 
         else:
             inputs = data['Imgs']
@@ -201,19 +315,31 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
             else:
                 self.image_paths = data['Paths']
 
-            self.isEmpty = False if any(self.valid) else True
-            if not self.isEmpty:
-                available_idx = torch.arange(len(self.class_A))
-                select_idx = torch.masked_select(available_idx, self.valid).long()
-                inputs = torch.index_select(inputs, 0, select_idx)
+            # copy the pinned batch before masking, masking on the host would make an unpinned copy
+            if len(self.gpu_ids) > 0:
+                inputs = inputs.cuda(non_blocking=True)
+                self.class_A = self.class_A.cuda(non_blocking=True)
 
-                self.class_A = torch.index_select(self.class_A, 0, select_idx)
-                self.image_paths = [val for i, val in enumerate(self.image_paths) if self.valid[i] == 1]
+            self.isEmpty = False if any(self.valid) else True
+            if not self.isEmpty and not self.valid.all():
+                valid_mask = self.valid.to(inputs.device)
+                inputs = inputs[valid_mask]
+                self.class_A = self.class_A[valid_mask]
+                self.image_paths = [path for path, valid in zip(self.image_paths, self.valid.tolist()) if valid]
 
             self.reals = inputs
 
-            if len(self.gpu_ids) > 0:
-                self.reals = self.reals.cuda()
+            # match the channels_last test generator, the training networks stay NCHW
+            if self.use_channels_last:
+                self.reals = self.reals.contiguous(memory_format=torch.channels_last)
+
+
+    def class_conditions(self, conditions, classes):
+        # add one-hot age codes to the noise in place, every class spans self.duplicate consecutive entries
+        device = conditions.device
+        idx = classes.long().view(-1, 1) * self.duplicate + torch.arange(self.duplicate, device=device)
+        conditions.scatter_add_(1, idx, torch.ones_like(idx, dtype=conditions.dtype))
+        return conditions
 
 
     def get_conditions(self, mode='train'):
@@ -226,31 +352,27 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
             else:
                 nb = self.numClasses
         else:
-            nb = self.numValid
-
-        #tex condition mapping
-        condG_A_gen = self.Tensor(nb, self.cond_length)
-        condG_B_gen = self.Tensor(nb, self.cond_length)
-        condG_A_orig = self.Tensor(nb, self.cond_length)
-        condG_B_orig = self.Tensor(nb, self.cond_length)
+            # all target classes are generated in a single batch
+            nb = self.numValid * self.numClasses
 
         if self.no_cond_noise:
             noise_sigma = 0
         else:
             noise_sigma = 0.2
 
-        for i in range(nb):
-            condG_A_gen[i, :] = (noise_sigma * torch.randn(1, self.cond_length)).cuda()
-            condG_A_gen[i, self.class_B[i]*self.duplicate:(self.class_B[i] + 1)*self.duplicate] += 1
-            if not (self.traverse or self.deploy):
-                condG_B_gen[i, :] = (noise_sigma * torch.randn(1, self.cond_length)).cuda()
-                condG_B_gen[i, self.class_A[i]*self.duplicate:(self.class_A[i] + 1)*self.duplicate] += 1
+        # draw the noise for all conditions at once directly on the GPU
+        num_conds = 1 if (self.traverse or self.deploy) else 4
+        noise = noise_sigma * torch.randn(num_conds, nb, self.cond_length, device=self.reals.device,
+                                          generator=self.cond_generator)
 
-                condG_A_orig[i, :] = (noise_sigma * torch.randn(1, self.cond_length)).cuda()
-                condG_A_orig[i, self.class_A[i]*self.duplicate:(self.class_A[i] + 1)*self.duplicate] += 1
-
-                condG_B_orig[i, :] = (noise_sigma * torch.randn(1, self.cond_length)).cuda()
-                condG_B_orig[i, self.class_B[i]*self.duplicate:(self.class_B[i] + 1)*self.duplicate] += 1
+        #tex condition mapping
+        condG_A_gen = self.class_conditions(noise[0], self.class_B)
+        if not (self.traverse or self.deploy):
+            # in test mode the source classes repeat for every target class
+            class_A = self.class_A.repeat(nb // self.class_A.shape[0])
+            condG_B_gen = self.class_conditions(noise[1], class_A)
+            condG_A_orig = self.class_conditions(noise[2], class_A)
+            condG_B_orig = self.class_conditions(noise[3], self.class_B)
 
         if mode == 'train':
             self.gen_conditions =  torch.cat((condG_A_gen, condG_B_gen), 0) #torch.cat((self.class_B, self.class_A), 0)
@@ -268,49 +390,49 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
     def update_G(self, infer=False):
         # Generator optimization setp
         self.optimizer_G.zero_grad()
-        self.get_conditions()
 
         ############### multi GPU ###############
-        rec_images, gen_images, cyc_images, orig_id_features, \
-        orig_age_features, fake_id_features, fake_age_features = \
-        self.netG(self.reals, self.gen_conditions, self.cyc_conditions, self.orig_conditions)
-
-        #discriminator pass
-        disc_out = self.netD(gen_images)
-
-        #self-reconstruction loss
-        if self.opt.lambda_rec > 0:
-            loss_G_Rec = self.criterionRec(rec_images, self.reals) * self.opt.lambda_rec
-        else:
-            loss_G_Rec = torch.zeros(1).cuda()
+        with self.autocast():
+            rec_images, gen_images, cyc_images, orig_id_features, \
+            orig_age_features, fake_id_features, fake_age_features = \
+            self.netG(self.reals, self.gen_conditions, self.cyc_conditions, self.orig_conditions)
+
+            #discriminator pass, D isn't updated in this step so skip the all-reduce of its gradients
+            with self.no_sync(self.netD):
+                disc_out = self.netD(gen_images)
+
+            #self-reconstruction loss
+            if self.opt.lambda_rec > 0:
+                loss_G_Rec = self.criterionRec(rec_images, self.reals) * self.opt.lambda_rec
+            else:
+                loss_G_Rec = torch.zeros(1).cuda()
 
-        #cycle loss
-        if self.opt.lambda_cyc > 0:
-            loss_G_Cycle = self.criterionCycle(cyc_images, self.reals) * self.opt.lambda_cyc
-        else:
-            loss_G_Cycle = torch.zeros(1).cuda()
+            #cycle loss
+            if self.opt.lambda_cyc > 0:
+                loss_G_Cycle = self.criterionCycle(cyc_images, self.reals) * self.opt.lambda_cyc
+            else:
+                loss_G_Cycle = torch.zeros(1).cuda()
 
-        # identity feature loss
-        loss_G_identity_reconst = self.identity_reconst_criterion(fake_id_features, orig_id_features) * self.opt.lambda_id
-        # age feature loss
-        loss_G_age_reconst = self.age_reconst_criterion(fake_age_features, self.gen_conditions) * self.opt.lambda_age
-        # orig age feature loss
-        loss_G_age_reconst += self.age_reconst_criterion(orig_age_features, self.orig_conditions) * self.opt.lambda_age
+            # identity feature loss
+            loss_G_identity_reconst = self.identity_reconst_criterion(fake_id_features, orig_id_features) * self.opt.lambda_id
+            # age feature loss
+            loss_G_age_reconst = self.age_reconst_criterion(fake_age_features, self.gen_conditions) * self.opt.lambda_age
+            # orig age feature loss
+            loss_G_age_reconst += self.age_reconst_criterion(orig_age_features, self.orig_conditions) * self.opt.lambda_age
 
-        # adversarial loss
-        target_classes = torch.cat((self.class_B,self.class_A),0)
-        loss_G_GAN = self.criterionGAN(disc_out, target_classes, True, is_gen=True)
+            # adversarial loss
+            target_classes = torch.cat((self.class_B,self.class_A),0)
+            loss_G_GAN = self.criterionGAN(disc_out, target_classes, True, is_gen=True)
 
-        # overall loss
-        loss_G = (loss_G_GAN + loss_G_Rec + loss_G_Cycle + \
-        loss_G_identity_reconst + loss_G_age_reconst).mean()
+            # overall loss
+            loss_G = (loss_G_GAN + loss_G_Rec + loss_G_Cycle + \
+            loss_G_identity_reconst + loss_G_age_reconst).mean()
 
-        loss_G.backward()
-        self.optimizer_G.step()
+        self.optimizer_step(loss_G, self.optimizer_G, self.scaler_G)
 
         # update exponential moving average
         if self.use_moving_avg:
-            self.accumulate(self.g_running, self.netG)
+            self.accumulate()
 
         # generate images for visdom
         if infer:
@@ -335,9 +457,11 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
                 if self.opt.lambda_cyc > 0:
                     cyc_images_out = cyc_images
 
-        loss_dict = {'loss_G_Adv': loss_G_GAN.mean(), 'loss_G_Cycle': loss_G_Cycle.mean(),
-                     'loss_G_Rec': loss_G_Rec.mean(), 'loss_G_identity_reconst': loss_G_identity_reconst.mean(),
-                     'loss_G_age_reconst': loss_G_age_reconst.mean()}
+        # the losses are already reduced, return them detached and on the GPU.
+        # They are only copied to the host (and synchronized) when printed.
+        loss_dict = {'loss_G_Adv': loss_G_GAN.detach(), 'loss_G_Cycle': loss_G_Cycle.detach(),
+                     'loss_G_Rec': loss_G_Rec.detach(), 'loss_G_identity_reconst': loss_G_identity_reconst.detach(),
+                     'loss_G_age_reconst': loss_G_age_reconst.detach()}
 
         return [loss_dict,
                 None if not infer else self.reals,
@@ -349,39 +473,43 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
     def update_D(self):
         # Discriminator optimization setp
         self.optimizer_D.zero_grad()
-        self.get_conditions()
 
         ############### multi GPU ###############
-        _, gen_images, _, _, _, _, _ = self.netG(self.reals, self.gen_conditions, None, None, disc_pass=True)
+        # the generated images are detached below, so no generator gradients are needed here.
+        # This also keeps DDP from waiting on a gradient reduction that never happens.
+        with torch.no_grad(), self.autocast():
+            _, gen_images, _, _, _, _, _ = self.netG(self.reals, self.gen_conditions, None, None, disc_pass=True)
 
-        #fake discriminator pass
-        fake_disc_in = gen_images.detach()
-        fake_disc_out = self.netD(fake_disc_in)
+        with self.autocast():
+            #fake discriminator pass
+            fake_disc_in = gen_images.detach()
+            fake_disc_out = self.netD(fake_disc_in)
 
-        #real discriminator pass
-        real_disc_in = self.reals
+            #real discriminator pass
+            real_disc_in = self.reals
 
-        # necessary for R1 regularization
-        real_disc_in.requires_grad_()
+            # necessary for R1 regularization
+            real_disc_in.requires_grad_()
 
-        real_disc_out = self.netD(real_disc_in)
+            real_disc_out = self.netD(real_disc_in)
 
-        #Fake GAN loss
-        fake_target_classes = torch.cat((self.class_B,self.class_A),0)
-        loss_D_fake = self.criterionGAN(fake_disc_out, fake_target_classes, False, is_gen=False)
+            #Fake GAN loss
+            fake_target_classes = torch.cat((self.class_B,self.class_A),0)
+            loss_D_fake = self.criterionGAN(fake_disc_out, fake_target_classes, False, is_gen=False)
 
-        #Real GAN loss
-        real_target_classes = torch.cat((self.class_A,self.class_B),0)
-        loss_D_real = self.criterionGAN(real_disc_out, real_target_classes, True, is_gen=False)
+            #Real GAN loss
+            real_target_classes = torch.cat((self.class_A,self.class_B),0)
+            loss_D_real = self.criterionGAN(real_disc_out, real_target_classes, True, is_gen=False)
 
-        # R1 regularization
-        loss_D_reg = self.R1_reg(real_disc_out, real_disc_in)
+        # R1 regularization, with amp the gradient is taken through D with the D loss scaler.
+        # real_disc_out is gathered on the output device by DataParallel (or is already local with DDP),
+        # so the gradient penalty runs on a single device
+        loss_D_reg = self.R1_reg(real_disc_out, real_disc_in, scaler=self.scaler_D)
 
         loss_D = (loss_D_fake + loss_D_real + loss_D_reg).mean()
-        loss_D.backward()
-        self.optimizer_D.step()
+        self.optimizer_step(loss_D, self.optimizer_D, self.scaler_D)
 
-        return {'loss_D_real': loss_D_real.mean(), 'loss_D_fake': loss_D_fake.mean(), 'loss_D_reg': loss_D_reg.mean()}
+        return {'loss_D_real': loss_D_real.detach(), 'loss_D_fake': loss_D_fake.detach(), 'loss_D_reg': loss_D_reg.detach()}
 
 
     def inference(self, data):
@@ -390,44 +518,94 @@ class LATS(BaseModel): #Lifetime Age Transformation Synthesis
             return
 
         self.numValid = self.valid.sum().item()
-        sz = self.reals.size()
-        self.fake_B = self.Tensor(self.numClasses, sz[0], sz[1], sz[2], sz[3])
-        self.cyc_A = self.Tensor(self.numClasses, sz[0], sz[1], sz[2], sz[3])
 
-        with torch.no_grad():
+        # inference_mode is only available in newer PyTorch versions
+        inference_mode = torch.inference_mode if hasattr(torch, 'inference_mode') else torch.no_grad
+        with inference_mode():
             if self.traverse or self.deploy:
                 if self.traverse and self.compare_to_trained_outputs:
                     start = self.compare_to_trained_class - self.trained_class_jump
                     end = start + (self.trained_class_jump * 2) * 2 #arange is between [start, end), end is always omitted
-                    self.class_B = torch.arange(start, end, step=self.trained_class_jump*2, dtype=self.class_A.dtype)
+                    self.class_B = torch.arange(start, end, step=self.trained_class_jump*2, dtype=self.class_A.dtype, device=self.class_A.device)
                 else:
-                    self.class_B = torch.arange(self.numClasses, dtype=self.class_A.dtype)
+                    self.class_B = torch.arange(self.numClasses, dtype=self.class_A.dtype, device=self.class_A.device)
 
                 self.get_conditions(mode='test')
 
                 self.fake_B = self.netG.infer(self.reals, self.gen_conditions, traverse=self.traverse, deploy=self.deploy, interp_step=self.opt.interp_step)
             else:
-                for i in range(self.numClasses):
-                    self.class_B = self.Tensor(self.numValid).long().fill_(i)
-                    self.get_conditions(mode='test')
+                if self.isTrain and self.use_moving_avg:
+                    netG = self.g_running
+                else:
+                    netG = self.netG
 
-                    if self.isTrain:
-                        self.fake_B[i, :, :, :, :] = self.g_running.infer(self.reals, self.gen_conditions)
-                    else:
-                        self.fake_B[i, :, :, :, :] = self.netG.infer(self.reals, self.gen_conditions)
+                # translate to all classes in a single batch, ordered class major
+                self.class_B = torch.arange(self.numClasses, dtype=self.class_A.dtype, device=self.class_A.device).repeat_interleave(self.numValid)
+                self.get_conditions(mode='test')
 
-                    cyc_input = self.fake_B[i, :, :, :, :]
+                if self.use_cuda_graph:
+                    # the graph output is already a static buffer
+                    fake_B = self.replay_translate(netG)
+                    self.fake_B = fake_B.view(self.numClasses, self.numValid, *fake_B.shape[1:])
+                else:
+                    fake_B = self.translate(netG, self.reals, self.gen_conditions)
+                    self.fake_B_buf = self.reuse_buffer(self.fake_B_buf, fake_B)
+                    self.fake_B = self.fake_B_buf
 
-                    if self.isTrain:
-                        self.cyc_A[i, :, :, :, :] = self.g_running.infer(cyc_input, self.cyc_conditions)
-                    else:
-                        self.cyc_A[i, :, :, :, :] = self.netG.infer(cyc_input, self.cyc_conditions)
+                # cycle reconstructions are only displayed in debug mode
+                if self.debug_mode:
+                    cyc_A = netG.infer(fake_B, self.cyc_conditions)
+                    self.cyc_A_buf = self.reuse_buffer(self.cyc_A_buf, cyc_A)
+                    self.cyc_A = self.cyc_A_buf
 
             visuals = self.get_visuals()
 
         return visuals
 
 
+    def reuse_buffer(self, buf, output):
+        # copy a class major batch of outputs into a persistent (numClasses, numValid, C, H, W) buffer,
+        # it's only reallocated when the input shape changes
+        out_shape = (self.numClasses, self.numValid) + tuple(output.shape[1:])
+        if buf is None or buf.shape != out_shape:
+            buf = torch.empty(out_shape, dtype=output.dtype, device=output.device)
+        buf.copy_(output.reshape(out_shape))
+        return buf
+
+
+    def translate(self, netG, reals, conditions):
+        # the identity features don't depend on the target class, encode them once
+        id_features = netG.id_encoder(reals).repeat(self.numClasses, 1, 1, 1)
+        return netG.decode(id_features, conditions)
+
+
+    def replay_translate(self, netG):
+        # the test input shape is fixed, so the translation is captured once in a CUDA graph
+        # and replayed with a single launch. It's recaptured whenever the input shape changes.
+        graph_shape = (tuple(self.reals.shape), tuple(self.gen_conditions.shape))
+        if self.infer_graph is None or self.infer_graph_shape != graph_shape:
+            self.static_reals = self.reals.clone()
+            self.static_conditions = self.gen_conditions.clone()
+
+            # warm up on a side stream before capturing, this also runs the cudnn autotuner
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                self.translate(netG, self.static_reals, self.static_conditions)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.infer_graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.infer_graph):
+                self.static_fake_B = self.translate(netG, self.static_reals, self.static_conditions)
+            self.infer_graph_shape = graph_shape
+
+        self.static_reals.copy_(self.reals)
+        self.static_conditions.copy_(self.gen_conditions)
+        self.infer_graph.replay()
+
+        return self.static_fake_B
+
+
     def save(self, which_epoch):
         self.save_network(self.netG, 'G', which_epoch, self.gpu_ids)
         self.save_network(self.netD, 'D', which_epoch, self.gpu_ids)
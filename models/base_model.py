@@ -14,6 +14,8 @@ class BaseModel(torch.nn.Module):
         self.gpu_ids = opt.gpu_ids
         self.isTrain = opt.isTrain
         self.Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.Tensor
+        # checkpoints are loaded directly to this process's GPU, not to the GPU they were saved from
+        self.device = torch.device('cuda:%d' % self.gpu_ids[0]) if len(self.gpu_ids) > 0 else torch.device('cpu')
         self.save_dir = os.path.join(opt.checkpoints_dir, opt.name)
 
     def set_input(self, input):
@@ -45,7 +47,7 @@ class BaseModel(torch.nn.Module):
     def save_network(self, network, network_label, epoch_label, gpu_ids):
         save_filename = '%s_net_%s.pth' % (epoch_label, network_label)
         save_path = os.path.join(self.save_dir, save_filename)
-        if isinstance(network,nn.DataParallel):
+        if isinstance(network,(nn.DataParallel, nn.parallel.DistributedDataParallel)):
             torch.save(network.module.state_dict(), save_path)
         else:
             torch.save(network.state_dict(), save_path)
@@ -62,13 +64,13 @@ class BaseModel(torch.nn.Module):
                 raise('Generator must exist!')
         else:
             try:
-                if isinstance(network,nn.DataParallel):
-                    network.module.load_state_dict(torch.load(save_path))
+                if isinstance(network,(nn.DataParallel, nn.parallel.DistributedDataParallel)):
+                    network.module.load_state_dict(torch.load(save_path, map_location=self.device))
                 else:
-                    network.load_state_dict(torch.load(save_path))
+                    network.load_state_dict(torch.load(save_path, map_location=self.device))
             except:
-                pretrained_dict = torch.load(save_path)
-                if isinstance(network,nn.DataParallel):
+                pretrained_dict = torch.load(save_path, map_location=self.device)
+                if isinstance(network,(nn.DataParallel, nn.parallel.DistributedDataParallel)):
                     model_dict = network.module.state_dict()
                 else:
                     model_dict = network.state_dict()
@@ -49,7 +49,7 @@ def define_G(input_nc, output_nc, ngf, n_downsample_global=2,
              id_enc_norm='pixel', gpu_ids=[], padding_type='reflect',
              style_dim=50, init_type='gaussian',
              conv_weight_norm=False, decoder_norm='pixel', activation='lrelu',
-             adaptive_blocks=4, normalize_mlp=False, modulated_conv=False):
+             adaptive_blocks=4, normalize_mlp=False, modulated_conv=False, verbose=True):
 
     id_enc_norm = get_norm_layer(norm_type=id_enc_norm)
 
@@ -59,7 +59,8 @@ def define_G(input_nc, output_nc, ngf, n_downsample_global=2,
                      actvn=activation, adaptive_blocks=adaptive_blocks,
                      normalize_mlp=normalize_mlp, modulated_conv=modulated_conv)
 
-    print(netG)
+    if verbose:
+        print(netG)
     if len(gpu_ids) > 0:
         assert(torch.cuda.is_available())
         netG.cuda(gpu_ids[0])
@@ -69,12 +70,13 @@ def define_G(input_nc, output_nc, ngf, n_downsample_global=2,
     return netG
 
 def define_D(input_nc, ndf, n_layers=6, numClasses=2, gpu_ids=[],
-             init_type='gaussian'):
+             init_type='gaussian', verbose=True):
 
     netD = StyleGANDiscriminator(input_nc, ndf=ndf, n_layers=n_layers,
                                  numClasses=numClasses)
 
-    print(netD)
+    if verbose:
+        print(netD)
     if len(gpu_ids) > 0:
         assert(torch.cuda.is_available())
         netD.cuda(gpu_ids[0])
@@ -108,6 +110,25 @@ class _CustomDataParallel(nn.DataParallel):
             return getattr(self.module, name)
 
 
+class _CustomDistributedDataParallel(nn.parallel.DistributedDataParallel):
+    def __init__(self, model, local_rank, static_graph=False):
+        # large buckets merge the many small MLP/affine gradients into few all-reduce calls
+        super(_CustomDistributedDataParallel, self).__init__(model.cuda(local_rank),
+                                                             device_ids=[local_rank],
+                                                             output_device=local_rank,
+                                                             broadcast_buffers=False,
+                                                             find_unused_parameters=False,
+                                                             bucket_cap_mb=50,
+                                                             gradient_as_bucket_view=True,
+                                                             static_graph=static_graph)
+
+    def __getattr__(self, name):
+        try:
+            return super(_CustomDistributedDataParallel, self).__getattr__(name)
+        except AttributeError:
+            return getattr(self.module, name)
+
+
 ##############################################################################
 # Losses
 ##############################################################################
@@ -124,14 +145,21 @@ class R1_reg(nn.Module):
         super(R1_reg, self).__init__()
         self.lambda_r1 = lambda_r1
 
-    def __call__(self, d_out, d_in):
+    def __call__(self, d_out, d_in, scaler=None):
         """Compute gradient penalty: (L2_norm(dy/dx))**2."""
         b = d_in.shape[0]
-        dydx = torch.autograd.grad(outputs=d_out.mean(),
+        d_out_mean = d_out.mean()
+        # with mixed precision, differentiate the loss-scaled output so the float16
+        # backward pass through D doesn't underflow, then unscale the gradient
+        if scaler is not None:
+            d_out_mean = scaler.scale(d_out_mean)
+        dydx = torch.autograd.grad(outputs=d_out_mean,
                                    inputs=d_in,
                                    retain_graph=True,
                                    create_graph=True,
                                    only_inputs=True)[0]
+        if scaler is not None:
+            dydx = dydx / scaler.get_scale()
         dydx_sq = dydx.pow(2)
         assert (dydx_sq.size() == d_in.size())
         r1_reg = dydx_sq.sum() / b
@@ -146,7 +174,7 @@ class SelectiveClassesNonSatGANLoss(nn.Module):
 
     def __call__(self, input, target_classes, target_is_real, is_gen=False):
         bSize = input.shape[0]
-        b_ind = torch.arange(bSize).long()
+        b_ind = torch.arange(bSize, device=input.device).long()
         relevant_inputs = input[b_ind, target_classes, :, :]
         if target_is_real:
             loss = self.sofplus(-relevant_inputs).mean()
@@ -246,9 +274,9 @@ class ModulatedConv2d(nn.Module):
         weight = s * weight
         if self.demudulate:
             d = torch.rsqrt((weight ** 2).sum(4).sum(3).sum(2) + 1e-5).view(-1, self.out_channels, 1, 1, 1)
-            weight = (d * weight).view(-1, self.in_channels, self.kernel_size, self.kernel_size)
+            weight = (d * weight).reshape(-1, self.in_channels, self.kernel_size, self.kernel_size)
         else:
-            weight = weight.view(-1, self.in_channels, self.kernel_size, self.kernel_size)
+            weight = weight.reshape(-1, self.in_channels, self.kernel_size, self.kernel_size)
 
         if self.upsample:
             input = self.upsampler(input)
@@ -257,9 +285,10 @@ class ModulatedConv2d(nn.Module):
             input = self.blur(input)
 
         b,_,h,w = input.shape
-        input = input.view(1,-1,h,w)
+        # reshape rather than view, the test generator runs on channels_last tensors
+        input = input.reshape(1,-1,h,w)
         input = self.padding(input)
-        out = self.conv(input, weight, groups=b).view(b, self.out_channels, h, w) + self.bias
+        out = self.conv(input, weight, groups=b).reshape(b, self.out_channels, h, w) + self.bias
 
         if self.downsample:
             out = self.downsampler(out)
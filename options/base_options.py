@@ -15,6 +15,7 @@ class BaseOptions():
         self.parser.add_argument('--name', type=str, default='debug', help='name of the experiment. It decides where to store samples and models')
         self.parser.add_argument('--gpu_ids', type=str, default='0', help='gpu ids: e.g. 0  0,1,2, 0,2. use -1 for CPU')
         self.parser.add_argument('--checkpoints_dir', type=str, default='./checkpoints', help='models are saved here')
+        self.parser.add_argument('--distributed', action='store_true', help='if specified, use DistributedDataParallel with one process per GPU (launch with torchrun)')
 
         # input/output sizes
         self.parser.add_argument('--batchSize', type=int, default=1, help='input batch size')
@@ -74,6 +75,17 @@ class BaseOptions():
             if id >= 0:
                 self.opt.gpu_ids.append(id)
 
+        # set distributed process info, torchrun exports these to every worker
+        self.opt.rank = int(os.environ.get('RANK', 0))
+        self.opt.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        self.opt.world_size = int(os.environ.get('WORLD_SIZE', 1))
+        if self.opt.distributed:
+            # each process drives a single GPU
+            self.opt.gpu_ids = [self.opt.local_rank]
+        if self.opt.rank != 0:
+            # only the first process prints verbose messages
+            self.opt.verbose = False
+
         # set gpu ids
         if len(self.opt.gpu_ids) > 0:
             torch.cuda.set_device(self.opt.gpu_ids[0])
@@ -100,19 +112,21 @@ class BaseOptions():
 
         args = vars(self.opt)
 
-        print('------------ Options -------------')
-        for k, v in sorted(args.items()):
-            print('%s: %s' % (str(k), str(v)))
-        print('-------------- End ----------------')
-
-        # save to the disk
-        expr_dir = os.path.join(self.opt.checkpoints_dir, self.opt.name)
-        util.mkdirs(expr_dir)
-        if save:# and not self.opt.continue_train:
-            file_name = os.path.join(expr_dir, 'opt.txt')
-            with open(file_name, 'wt') as opt_file:
-                opt_file.write('------------ Options -------------\n')
-                for k, v in sorted(args.items()):
-                    opt_file.write('%s: %s\n' % (str(k), str(v)))
-                opt_file.write('-------------- End ----------------\n')
+        # with torchrun only the first process reports and saves the options
+        if self.opt.rank == 0:
+            print('------------ Options -------------')
+            for k, v in sorted(args.items()):
+                print('%s: %s' % (str(k), str(v)))
+            print('-------------- End ----------------')
+
+            # save to the disk
+            expr_dir = os.path.join(self.opt.checkpoints_dir, self.opt.name)
+            util.mkdirs(expr_dir)
+            if save:# and not self.opt.continue_train:
+                file_name = os.path.join(expr_dir, 'opt.txt')
+                with open(file_name, 'wt') as opt_file:
+                    opt_file.write('------------ Options -------------\n')
+                    for k, v in sorted(args.items()):
+                        opt_file.write('%s: %s\n' % (str(k), str(v)))
+                    opt_file.write('-------------- End ----------------\n')
         return self.opt
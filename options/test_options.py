@@ -21,5 +21,6 @@ class TestOptions(BaseOptions):
         self.parser.add_argument('--interp_step', type=float, default=0.5, help='step size of interpolated w space vectors between each 2 true w space vectors')
         self.parser.add_argument('--deploy', action='store_true', help='when true, run forward pass on a list of images')
         self.parser.add_argument('--image_path_file', type=str, help='a file with a list of images to perform run through the network and/or latent space traversal on')
+        self.parser.add_argument('--no_cuda_graph', action='store_true', help='if specified, do not capture the test time generator pass in a CUDA graph')
         self.parser.add_argument('--debug_mode', action='store_true', help='when true, all intermediate outputs are saved to the html file')
         self.isTrain = False
@@ -0,0 +1 @@
+CUDA_VISIBLE_DEVICES=0,1,2,3 torchrun --nproc_per_node=4 train.py --distributed --dataroot ./datasets/males --name males_model --batchSize 2 --verbose
@@ -16,6 +16,9 @@ from pdb import set_trace as st
 def train(opt):
     iter_path = os.path.join(opt.checkpoints_dir, opt.name, 'iter.txt')
 
+    # in distributed mode only the first process logs, displays and saves checkpoints
+    is_main_process = (not opt.distributed) or opt.rank == 0
+
     if opt.continue_train:
         if opt.which_epoch == 'latest':
             try:
@@ -25,7 +28,8 @@ def train(opt):
         else:
             start_epoch, epoch_iter = int(opt.which_epoch), 0
 
-        print('Resuming from epoch %d at iteration %d' % (start_epoch, epoch_iter))
+        if is_main_process:
+            print('Resuming from epoch %d at iteration %d' % (start_epoch, epoch_iter))
         for update_point in opt.decay_epochs:
             if start_epoch < update_point:
                 break
@@ -37,10 +41,14 @@ def train(opt):
     data_loader = CreateDataLoader(opt)
     dataset = data_loader.load_data()
     dataset_size = len(data_loader)
-    print('#training images = %d' % dataset_size)
+    if is_main_process:
+        if opt.distributed:
+            print('#training images per process = %d' % dataset_size)
+        else:
+            print('#training images = %d' % dataset_size)
 
     model = create_model(opt)
-    visualizer = Visualizer(opt)
+    visualizer = Visualizer(opt) if is_main_process else None
 
     total_steps = (start_epoch) * dataset_size + epoch_iter
 
@@ -71,13 +79,15 @@ def train(opt):
         epoch_start_time = time.time()
         if epoch != start_epoch:
             epoch_iter = 0
+        if data_loader.sampler is not None:
+            data_loader.sampler.set_epoch(epoch)
         for i, data in enumerate(dataset, start=epoch_iter):
             iter_start_time = time.time()
             total_steps += opt.batchSize
             epoch_iter += opt.batchSize
 
             # whether to collect output images
-            save_fake = (total_steps % opt.display_freq == display_delta) and (opt.display_id > 0)
+            save_fake = (total_steps % opt.display_freq == display_delta) and (opt.display_id > 0) and is_main_process
 
             ############## Network Pass ########################
             model.set_inputs(data)
@@ -88,7 +98,7 @@ def train(opt):
 
             ############## Display results and errors ##########
             ### print out errors
-            if total_steps % opt.print_freq == print_delta:
+            if total_steps % opt.print_freq == print_delta and is_main_process:
                 errors = {k: v.item() if not (isinstance(v, float) or isinstance(v, int)) else v for k, v in loss_dict.items()}
                 t = (time.time() - iter_start_time) / opt.batchSize
                 visualizer.print_current_errors(epoch+1, epoch_iter, errors, t)
@@ -123,7 +133,7 @@ def train(opt):
                 visualizer.display_current_results(visuals, epoch, classes, ncols)
 
             ### save latest model
-            if total_steps % opt.save_latest_freq == save_delta:
+            if total_steps % opt.save_latest_freq == save_delta and is_main_process:
                 print('saving the latest model (epoch %d, total_steps %d)' % (epoch+1, total_steps))
                 model.save('latest')
                 np.savetxt(iter_path, (epoch, epoch_iter), delimiter=',', fmt='%d')
@@ -135,11 +145,12 @@ def train(opt):
 
         # end of epoch
         iter_end_time = time.time()
-        print('End of epoch %d / %d \t Time Taken: %d sec' %
-              (epoch+1, opt.epochs, time.time() - epoch_start_time))
+        if is_main_process:
+            print('End of epoch %d / %d \t Time Taken: %d sec' %
+                  (epoch+1, opt.epochs, time.time() - epoch_start_time))
 
         ### save model for this epoch
-        if (epoch+1) % opt.save_epoch_freq == 0:
+        if (epoch+1) % opt.save_epoch_freq == 0 and is_main_process:
             print('saving the model at the end of epoch %d, iters %d' % (epoch+1, total_steps))
             model.save('latest')
             model.save(epoch+1)